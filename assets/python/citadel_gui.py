@@ -1,22 +1,29 @@
 import json
 import os
-import random
 import shutil
 import subprocess
 import sys
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterator
+from typing import Callable
 
+import numpy as np
 from midiutil import MIDIFile
 from PySide6 import QtCore, QtGui, QtWidgets
 
+
+@lru_cache(maxsize=4)
+def _load_json(path: str, mtime_ns: int) -> dict:
+    return json.loads(Path(path).read_text())
+
+
 HOME = Path.home()
 BASE = Path(os.environ.get("CITADEL_HOME", str(HOME / "DaftCitadel")))
 PROFILE_FILE = BASE / "citadel_profile.json"
 PROFILE_DATA: dict = {"features": {}}
 if PROFILE_FILE.exists():
     try:
-        PROFILE_DATA = json.loads(PROFILE_FILE.read_text())
+        PROFILE_DATA = _load_json(str(PROFILE_FILE), PROFILE_FILE.stat().st_mtime_ns)
     except json.JSONDecodeError:
         PROFILE_DATA = {"features": {}}
 FEATURES = PROFILE_DATA.get("features", {})
@@ -32,12 +39,16 @@ PYTHON_BIN = VENV_BIN / "python"
 TRAINER = BASE / "daft_midi_trainer.py"
 SF2 = Path("/usr/share/sounds/sf2/FluidR3_GM.sf2")
 STYLES = ["da_funk", "around_world", "harder_better"]
+PRESET_SUFFIXES = frozenset({"vital", "vitalbank", "fxp", "surge", "preset"})
+SAMPLE_SUFFIXES = frozenset({"wav"})
+
+_SCAN_CACHE: dict[tuple[str, frozenset[str]], tuple[dict[str, int], list[str]]] = {}
 
 
 def load_cfg() -> dict:
     if CFG_FILE.exists():
         try:
-            return json.loads(CFG_FILE.read_text())
+            return dict(_load_json(str(CFG_FILE), CFG_FILE.stat().st_mtime_ns))
         except json.JSONDecodeError:
             pass
     defaults = {"quantum": 32, "style": STYLES[0], "tempo": 128, "bars": 16}
@@ -49,13 +60,60 @@ def save_cfg(cfg: dict) -> None:
     CFG_FILE.write_text(json.dumps(cfg, indent=2))
 
 
-def run_stream(cmd: list[str]) -> Iterator[str]:
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if process.stdout:
-        for line in process.stdout:
-            yield line.rstrip()
-    process.wait()
-    yield f"[exit {process.returncode}]"
+def _dirs_unchanged(dir_mtimes: dict[str, int]) -> bool:
+    for directory, mtime_ns in dir_mtimes.items():
+        try:
+            if os.stat(directory).st_mtime_ns != mtime_ns:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _scan(root: Path, suffixes: frozenset[str]) -> list[str]:
+    key = (str(root), suffixes)
+    cached = _SCAN_CACHE.get(key)
+    if cached is not None and _dirs_unchanged(cached[0]):
+        return cached[1]
+    dir_mtimes: dict[str, int] = {}
+    found: list[str] = []
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            dir_mtimes[current] = os.stat(current).st_mtime_ns
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    _, dot, ext = entry.name.rpartition(".")
+                    if dot and ext.lower() in suffixes and entry.is_file():
+                        found.append(entry.path)
+        except OSError:
+            continue
+    found.sort()
+    _SCAN_CACHE[key] = (dir_mtimes, found)
+    return found
+
+
+@lru_cache(maxsize=4)
+def _read_text(path: str, mtime_ns: int) -> str:
+    return Path(path).read_text()
+
+
+def _pixmap(path: Path) -> QtGui.QPixmap:
+    key = f"{path}:{path.stat().st_mtime_ns}"
+    pixmap = QtGui.QPixmap()
+    if not QtGui.QPixmapCache.find(key, pixmap):
+        pixmap = QtGui.QPixmap(str(path))
+        QtGui.QPixmapCache.insert(key, pixmap)
+    return pixmap
+
+
+@lru_cache(maxsize=None)
+def _which(name: str) -> str | None:
+    return shutil.which(name)
 
 
 class LogView(QtWidgets.QPlainTextEdit):
@@ -63,9 +121,22 @@ class LogView(QtWidgets.QPlainTextEdit):
         super().__init__()
         self.setReadOnly(True)
         self.setMaximumBlockCount(10000)
+        self._pending: list[str] = []
+        self._flush_scheduled = False
 
     def append(self, text: str) -> None:
-        self.appendPlainText(text)
+        self._pending.append(text)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            QtCore.QTimer.singleShot(30, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        joined = "\n".join(self._pending)
+        self._pending.clear()
+        self.appendPlainText(joined)
 
 
 class CitadelGUI(QtWidgets.QMainWindow):
@@ -74,19 +145,26 @@ class CitadelGUI(QtWidgets.QMainWindow):
         self.setWindowTitle("Daft Citadel — Control Surface")
         self.resize(1380, 820)
 
-        if (THEME_DIR / "style.qss").exists():
-            self.setStyleSheet((THEME_DIR / "style.qss").read_text())
+        qss_path = THEME_DIR / "style.qss"
+        if qss_path.exists():
+            self.setStyleSheet(_read_text(str(qss_path), qss_path.stat().st_mtime_ns))
         bg_path = THEME_DIR / "background.jpg"
         if bg_path.exists():
             palette = QtGui.QPalette()
-            palette.setBrush(QtGui.QPalette.Window, QtGui.QBrush(QtGui.QPixmap(str(bg_path))))
+            palette.setBrush(QtGui.QPalette.Window, QtGui.QBrush(_pixmap(bg_path)))
             self.setPalette(palette)
         icon_png = THEME_DIR / "icon.png"
         if icon_png.exists():
-            self.setWindowIcon(QtGui.QIcon(str(icon_png)))
+            self.setWindowIcon(QtGui.QIcon(_pixmap(icon_png)))
 
         self.cfg = load_cfg()
+        self._cfg_timer = QtCore.QTimer(self)
+        self._cfg_timer.setSingleShot(True)
+        self._cfg_timer.timeout.connect(lambda: save_cfg(self.cfg))
         self.log = LogView()
+        self._processes: list[QtCore.QProcess] = []
+        self._trainer_proc: QtCore.QProcess | None = None
+        self._preview_proc: QtCore.QProcess | None = None
 
         self.audio_btn = QtWidgets.QPushButton("Initialize Audio")
         self.quantum_btn = QtWidgets.QPushButton(f"Quantum: {self.cfg['quantum']} frames")
@@ -213,13 +291,16 @@ class CitadelGUI(QtWidgets.QMainWindow):
         self.log.append(f"[Container] {'yes' if CONTAINER_MODE else 'no'}")
 
     def initialize_audio(self) -> None:
-        if shutil.which("systemctl") and not CONTAINER_MODE:
+        if _which("systemctl") and not CONTAINER_MODE:
             cmd = ["systemctl", "--user", "enable", "--now", "pipewire", "pipewire-pulse", "wireplumber"]
-            self._run_and_log(cmd)
+            self._run_and_log(cmd, on_finished=lambda: self._apply_quantum(self.cfg["quantum"]))
         else:
             self.log.append("[SKIP] systemctl not available in this environment")
-        if shutil.which("pw-metadata"):
-            cmd = ["pw-metadata", "-n", "settings", "0", "clock.force-quantum", str(self.cfg["quantum"])]
+            self._apply_quantum(self.cfg["quantum"])
+
+    def _apply_quantum(self, value: int) -> None:
+        if _which("pw-metadata"):
+            cmd = ["pw-metadata", "-n", "settings", "0", "clock.force-quantum", str(value)]
             self._run_and_log(cmd)
         else:
             self.log.append("[WARN] pw-metadata not found")
@@ -231,11 +312,7 @@ class CitadelGUI(QtWidgets.QMainWindow):
         self.cfg["quantum"] = value
         save_cfg(self.cfg)
         self.quantum_btn.setText(f"Quantum: {value} frames")
-        if shutil.which("pw-metadata"):
-            cmd = ["pw-metadata", "-n", "settings", "0", "clock.force-quantum", str(value)]
-            self._run_and_log(cmd)
-        else:
-            self.log.append("[WARN] pw-metadata not found")
+        self._apply_quantum(value)
 
     def generate_quick(self) -> None:
         style = self.cfg["style"]
@@ -248,10 +325,12 @@ class CitadelGUI(QtWidgets.QMainWindow):
             "around_world": [60, 62, 64, 67, 69, 71],
             "harder_better": [48, 50, 53, 55, 58, 60],
         }.get(style, [60])
-        timestamp = 0.0
-        for _ in range(bars * 16):
-            midi.addNote(0, 0, random.choice(note_pool), timestamp, 0.25, random.randint(80, 120))
-            timestamp += 0.25
+        n = bars * 16
+        rng = np.random.default_rng()
+        pitches = rng.choice(note_pool, size=n)
+        velocities = rng.integers(80, 121, size=n)
+        for i, (pitch, velocity) in enumerate(zip(pitches.tolist(), velocities.tolist())):
+            midi.addNote(0, 0, pitch, i * 0.25, 0.25, velocity)
         output = BASE / "MIDIs" / f"quick_{style}.mid"
         with open(output, "wb") as handle:
             midi.writeFile(handle)
@@ -262,21 +341,15 @@ class CitadelGUI(QtWidgets.QMainWindow):
         if not self.ai_available:
             self.log.append("[WARN] AI toolchain is not available.")
             return
-        style = self.cfg["style"]
-        tempo = self.cfg["tempo"]
-        bars = self.cfg["bars"]
-        cmd = [str(PYTHON_BIN), str(TRAINER), f"--generate={style}", f"--tempo={tempo}", f"--bars={bars}"]
-        self._run_and_log(cmd)
+        self._trainer_request({"op": "gen", "style": self.cfg["style"], "tempo": self.cfg["tempo"], "bars": self.cfg["bars"]})
 
     def generate_isobar(self) -> None:
         if not self.ai_available:
             self.log.append("[WARN] AI toolchain is not available.")
             return
-        style = self.cfg["style"]
-        tempo = self.cfg["tempo"]
-        bars = self.cfg["bars"]
-        cmd = [str(PYTHON_BIN), str(TRAINER), f"--generate={style}", "--isobar", f"--tempo={tempo}", f"--bars={bars}"]
-        self._run_and_log(cmd)
+        self._trainer_request(
+            {"op": "gen", "isobar": True, "style": self.cfg["style"], "tempo": self.cfg["tempo"], "bars": self.cfg["bars"]}
+        )
 
     def preview_latest(self) -> None:
         midis = sorted((BASE / "MIDIs").glob("*.mid"), key=lambda p: p.stat().st_mtime, reverse=True)
@@ -289,21 +362,23 @@ class CitadelGUI(QtWidgets.QMainWindow):
         if not SF2.exists():
             self.log.append(f"[WARN] SoundFont missing: {SF2}")
             return
-        if not shutil.which("fluidsynth"):
+        if not _which("fluidsynth"):
             self.log.append("[WARN] fluidsynth executable not found")
             return
+        if self._preview_proc is not None:
+            self.log.append("[PREVIEW] Stopping previous preview")
+            self._preview_proc.kill()
         cmd = ["fluidsynth", "-a", "pulseaudio", str(SF2), str(path)]
-        self._run_and_log(cmd)
+        self._preview_proc = self._run_and_log(cmd)
 
     def train_model(self) -> None:
         if not self.ai_available:
             self.log.append("[WARN] AI toolchain is not available.")
             return
-        cmd = [str(PYTHON_BIN), str(TRAINER), "--train"]
-        self._run_and_log(cmd)
+        self._trainer_request({"op": "train"})
 
     def launch_ardour(self) -> None:
-        if not shutil.which("ardour"):
+        if not _which("ardour"):
             self.log.append("[WARN] Ardour executable not found")
             return
         template = self.template_combo.currentText()
@@ -314,7 +389,7 @@ class CitadelGUI(QtWidgets.QMainWindow):
         self._run_and_log(cmd, spawn=True)
 
     def launch_process(self, name: str) -> None:
-        if not shutil.which(name):
+        if not _which(name):
             self.log.append(f"[WARN] {name} executable not found")
             return
         self._run_and_log([name], spawn=True)
@@ -324,17 +399,14 @@ class CitadelGUI(QtWidgets.QMainWindow):
         self.samples_list.clear()
         presets_dir = BASE / "Presets"
         if presets_dir.exists():
-            for preset in sorted(presets_dir.rglob("*")):
-                if preset.suffix.lower() in {".vital", ".vitalbank", ".fxp", ".surge", ".preset"}:
-                    self.presets_list.addItem(str(preset.relative_to(BASE)))
+            self.presets_list.addItems([os.path.relpath(p, BASE) for p in _scan(presets_dir, PRESET_SUFFIXES)])
         samples_dir = BASE / "Samples"
         if samples_dir.exists():
-            for sample in sorted(samples_dir.rglob("*.wav")):
-                self.samples_list.addItem(str(sample.relative_to(BASE)))
+            self.samples_list.addItems([os.path.relpath(p, BASE) for p in _scan(samples_dir, SAMPLE_SUFFIXES)])
 
     def open_path(self, path: Path) -> None:
         path.mkdir(parents=True, exist_ok=True)
-        opener = shutil.which("xdg-open")
+        opener = _which("xdg-open")
         if opener:
             subprocess.Popen([opener, str(path)])
         else:
@@ -342,31 +414,111 @@ class CitadelGUI(QtWidgets.QMainWindow):
 
     def _change_style(self, style: str) -> None:
         self.cfg["style"] = style
-        save_cfg(self.cfg)
+        self._cfg_timer.start(250)
 
     def _change_tempo(self, value: int) -> None:
         self.cfg["tempo"] = value
-        save_cfg(self.cfg)
+        self._cfg_timer.start(250)
 
     def _change_bars(self, value: int) -> None:
         self.cfg["bars"] = value
-        save_cfg(self.cfg)
+        self._cfg_timer.start(250)
+
+    def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        if self._cfg_timer.isActive():
+            self._cfg_timer.stop()
+            save_cfg(self.cfg)
+        if self._trainer_proc is not None:
+            self._trainer_proc.closeWriteChannel()
+            self._trainer_proc.waitForFinished(3000)
+        super().closeEvent(event)
 
     def _focus_asset(self, item: QtWidgets.QListWidgetItem) -> None:
         path = BASE / item.text()
         self.log.append(f"[ASSET] {path}")
 
-    def _run_and_log(self, cmd: list[str], spawn: bool = False) -> None:
+    def _run_and_log(
+        self, cmd: list[str], spawn: bool = False, on_finished: Callable[[], None] | None = None
+    ) -> QtCore.QProcess | None:
         self.log.append(f"$ {' '.join(cmd)}")
         if spawn:
-            subprocess.Popen(cmd)
+            QtCore.QProcess.startDetached(cmd[0], cmd[1:])
+            return None
+        proc = QtCore.QProcess(self)
+        proc.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+        proc.readyReadStandardOutput.connect(lambda: self._drain_output(proc))
+        proc.finished.connect(lambda code, _status: self._process_finished(proc, code, on_finished))
+        proc.errorOccurred.connect(lambda error: self._process_failed(proc, error, on_finished))
+        self._processes.append(proc)
+        proc.start(cmd[0], cmd[1:])
+        return proc
+
+    def _trainer_request(self, request: dict) -> None:
+        proc = self._trainer_proc
+        if proc is None:
+            proc = QtCore.QProcess(self)
+            proc.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+            proc.readyReadStandardOutput.connect(lambda: self._drain_output(proc))
+            proc.finished.connect(lambda code, _status: self._trainer_stopped(proc, f"[trainer exit {code}]"))
+            proc.errorOccurred.connect(lambda error: self._trainer_failed(proc, error))
+            self._trainer_proc = proc
+            self.log.append(f"$ {PYTHON_BIN} {TRAINER} --server")
+            proc.start(str(PYTHON_BIN), [str(TRAINER), "--server"])
+        self.log.append(f"[TRAINER] {json.dumps(request)}")
+        proc.write((json.dumps(request) + "\n").encode())
+
+    def _trainer_failed(self, proc: QtCore.QProcess, error: QtCore.QProcess.ProcessError) -> None:
+        if error == QtCore.QProcess.FailedToStart:
+            self._trainer_stopped(proc, f"[ERR] Trainer failed to start: {proc.errorString()}")
+
+    def _trainer_stopped(self, proc: QtCore.QProcess, message: str) -> None:
+        self._drain_output(proc, final=True)
+        self.log.append(message)
+        if self._trainer_proc is proc:
+            self._trainer_proc = None
+        proc.deleteLater()
+
+    def _drain_output(self, proc: QtCore.QProcess, final: bool = False) -> None:
+        while proc.canReadLine():
+            self.log.append(bytes(proc.readLine()).decode(errors="replace").rstrip())
+        if final:
+            remainder = bytes(proc.readAllStandardOutput()).decode(errors="replace")
+            for line in remainder.splitlines():
+                self.log.append(line.rstrip())
+
+    def _process_finished(
+        self, proc: QtCore.QProcess, code: int, on_finished: Callable[[], None] | None = None
+    ) -> None:
+        self._drain_output(proc, final=True)
+        self.log.append(f"[exit {code}]")
+        self._release_process(proc)
+        if on_finished is not None:
+            on_finished()
+
+    def _process_failed(
+        self,
+        proc: QtCore.QProcess,
+        error: QtCore.QProcess.ProcessError,
+        on_finished: Callable[[], None] | None = None,
+    ) -> None:
+        if error != QtCore.QProcess.FailedToStart:
             return
-        for line in run_stream(cmd):
-            self.log.append(line)
+        self.log.append(f"[ERR] {proc.program()} failed to start: {proc.errorString()}")
+        self._release_process(proc)
+        if on_finished is not None:
+            on_finished()
+
+    def _release_process(self, proc: QtCore.QProcess) -> None:
+        if proc in self._processes:
+            self._processes.remove(proc)
+        if proc is self._preview_proc:
+            self._preview_proc = None
+        proc.deleteLater()
 
 
 def main() -> None:
     app = QtWidgets.QApplication(sys.argv)
+    QtGui.QPixmapCache.setCacheLimit(20480)
     window = CitadelGUI()
     window.show()
     sys.exit(app.exec())
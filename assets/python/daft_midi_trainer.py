@@ -1,19 +1,85 @@
+import hashlib
+import json
 import os
 import subprocess
+import sys
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List
 
+import mido
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from midiutil import MIDIFile
-from music21 import chord, converter, note
 
 import isobar as iso
 
 
+Token = int | tuple[int, ...]
+DRUM_CHANNEL = 9
+# Bump whenever _parse_one or the token encoding changes so cached corpora are rebuilt.
+TOKENIZER_VERSION = 2
+
+
+def _token_sort_key(token: Token) -> tuple[int, ...]:
+    return token if isinstance(token, tuple) else (token,)
+
+
+def _legacy_token(name: str) -> Token:
+    from music21 import note  # pylint: disable=import-outside-toplevel
+
+    pitches = tuple(sorted(note.Note(component).pitch.midi for component in name.split(".")))
+    return pitches[0] if len(pitches) == 1 else pitches
+
+
+def _parse_one(path: str) -> List[Token]:
+    try:
+        midi = mido.MidiFile(path)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] Could not parse {path}: {exc}")
+        return []
+    onsets: Dict[tuple[int, int, int], set[int]] = {}
+    for track_index, track in enumerate(midi.tracks):
+        tick = 0
+        for message in track:
+            tick += message.time
+            if message.type != "note_on" or message.velocity == 0 or message.channel == DRUM_CHANNEL:
+                continue
+            onsets.setdefault((tick, track_index, message.channel), set()).add(message.note)
+    notes: List[Token] = []
+    for key in sorted(onsets):
+        pitches = onsets[key]
+        notes.append(next(iter(pitches)) if len(pitches) == 1 else tuple(sorted(pitches)))
+    return notes
+
+
+def _compile(model: nn.Module, **kwargs) -> nn.Module:
+    if not hasattr(torch, "compile"):
+        return model
+    try:
+        # Dynamo compiles lazily on the first forward; fall back to eager there too.
+        torch._dynamo.config.suppress_errors = True  # pylint: disable=protected-access
+        return torch.compile(model, **kwargs)
+    except (AttributeError, RuntimeError) as exc:
+        print(f"[WARN] torch.compile unavailable, running eagerly: {exc}")
+        return model
+
+
+class SequenceWindows(torch.utils.data.Dataset):
+    def __init__(self, indices: torch.Tensor, sequence_length: int):
+        self.indices = indices
+        self.sequence_length = sequence_length
+
+    def __len__(self) -> int:
+        return len(self.indices) - self.sequence_length
+
+    def __getitem__(self, i: int) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.indices[i : i + self.sequence_length], self.indices[i + 1 : i + self.sequence_length + 1]
+
+
 class DaftMIDITransformer(nn.Module):
     def __init__(self, vocab_size: int, sequence_length: int = 64, d_model: int = 256, nhead: int = 8, num_layers: int = 6):
         super().__init__()
@@ -40,9 +106,12 @@ class DaftMIDITrainer:
         self.models_dir.mkdir(parents=True, exist_ok=True)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.sequence_length = 64
-        self.note_to_idx: Dict[str, int] = {}
-        self.idx_to_note: Dict[int, str] = {}
-        self.model: DaftMIDITransformer | None = None
+        self.note_to_idx: Dict[Token, int] = {}
+        self.idx_to_note: Dict[int, Token] = {}
+        self.idx_to_midi: Dict[int, List[int]] = {}
+        self.model: nn.Module | None = None
+        self.compile_inference = False
+        self._model_mtime_ns: int | None = None
         self.sf2 = Path("/usr/share/sounds/sf2/FluidR3_GM.sf2")
 
     def _download_corpus(self) -> None:
@@ -52,66 +121,102 @@ class DaftMIDITrainer:
             "around_the_world.mid": "https://mididb.com/files/DaftPunk_AroundTheWorld.mid",
             "daft_pack.zip": "https://archive.org/download/daft_punk_midi_samples/daft_midi_pack.zip",
         }
-        for name, url in sources.items():
-            target = self.midis_dir / name
-            if target.exists():
-                continue
-            subprocess.run(["curl", "-L", "--fail", "--retry", "5", url, "-o", str(target)], check=True)
-            if target.suffix == ".zip":
-                with zipfile.ZipFile(target) as zf:
-                    zf.extractall(self.midis_dir)
-                target.unlink(missing_ok=True)
+        pending = {name: url for name, url in sources.items() if not (self.midis_dir / name).exists()}
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            list(executor.map(self._fetch, pending.keys(), pending.values()))
 
-    def _prepare_sequences(self) -> np.ndarray:
-        notes: List[str] = []
-        for midi_file in sorted(self.midis_dir.glob("*.mid")):
-            try:
-                parsed = converter.parse(midi_file)
-            except Exception as exc:  # pylint: disable=broad-except
-                print(f"[WARN] Could not parse {midi_file}: {exc}")
-                continue
-            for element in parsed.flat.notes:
-                if isinstance(element, note.Note):
-                    notes.append(str(element.pitch))
-                elif isinstance(element, chord.Chord):
-                    notes.append(".".join(str(n) for n in element.pitches))
-        unique = sorted(set(notes))
-        if not unique:
+    def _fetch(self, name: str, url: str) -> None:
+        target = self.midis_dir / name
+        subprocess.run(["curl", "-L", "--fail", "--retry", "5", url, "-o", str(target)], check=True)
+        if target.suffix == ".zip":
+            with zipfile.ZipFile(target) as zf:
+                zf.extractall(self.midis_dir)
+            target.unlink(missing_ok=True)
+
+    def _parse_corpus(self, midi_files: List[Path]) -> tuple[List[Token], np.ndarray]:
+        notes: List[Token] = []
+        with ProcessPoolExecutor() as executor:
+            for result in executor.map(_parse_one, [str(p) for p in midi_files], chunksize=4):
+                notes.extend(result)
+        vocab = sorted(set(notes), key=_token_sort_key)
+        lookup = {n: i for i, n in enumerate(vocab)}
+        indices = np.fromiter((lookup[n] for n in notes), dtype=np.int64, count=len(notes))
+        return vocab, indices
+
+    def _load_corpus(self) -> np.ndarray:
+        midi_files = sorted(self.midis_dir.glob("*.mid"))
+        fingerprint = repr((TOKENIZER_VERSION, [(p.name, p.stat().st_mtime_ns) for p in midi_files])).encode()
+        key = hashlib.blake2b(fingerprint, digest_size=16).hexdigest()
+        cache = self.models_dir / f"corpus_{key}.npz"
+        if cache.exists():
+            with np.load(cache) as archive:
+                indices = archive["indices"]
+                vocab = [tuple(v) if isinstance(v, list) else v for v in json.loads(str(archive["vocab"]))]
+        else:
+            vocab, indices = self._parse_corpus(midi_files)
+            if vocab:
+                for stale in self.models_dir.glob("corpus_*.npz"):
+                    stale.unlink(missing_ok=True)
+                np.savez(cache, indices=indices, vocab=np.array(json.dumps(vocab)))
+        if not vocab:
             raise RuntimeError("No MIDI notes were extracted from the corpus.")
-        self.note_to_idx = {n: i for i, n in enumerate(unique)}
+        self.note_to_idx = {n: i for i, n in enumerate(vocab)}
         self.idx_to_note = {i: n for n, i in self.note_to_idx.items()}
-        indices = [self.note_to_idx[n] for n in notes]
-        sequences = []
-        for i in range(0, len(indices) - self.sequence_length):
-            chunk = indices[i : i + self.sequence_length + 1]
-            sequences.append(chunk)
-        if len(sequences) < 32:
+        self._index_pitches()
+        return indices
+
+    def _index_pitches(self) -> None:
+        self.idx_to_midi = {i: list(v) if isinstance(v, tuple) else [v] for i, v in self.idx_to_note.items()}
+
+    def _prepare_sequences(self) -> np.ndarray:
+        indices = self._load_corpus()
+        if len(indices) - self.sequence_length < 32:
             raise RuntimeError("Insufficient MIDI material. Add more files to ~/DaftCitadel/MIDIs.")
-        return np.array(sequences, dtype=np.int64)
+        return indices
 
     def train(self, epochs: int = 50, lr: float = 5e-4) -> Path:
         self._download_corpus()
-        data = self._prepare_sequences()
-        x = torch.tensor(data[:, :-1], dtype=torch.long, device=self.device)
-        y = torch.tensor(data[:, 1:], dtype=torch.long, device=self.device)
-        dataset = torch.utils.data.TensorDataset(x, y)
-        loader = torch.utils.data.DataLoader(dataset, batch_size=64, shuffle=True)
+        indices = self._prepare_sequences()
+        dataset = SequenceWindows(torch.from_numpy(indices), self.sequence_length)
+        use_cuda = self.device.type == "cuda"
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=64,
+            shuffle=True,
+            num_workers=2 if use_cuda else 0,
+            pin_memory=use_cuda,
+            persistent_workers=use_cuda,
+        )
 
         model = DaftMIDITransformer(len(self.note_to_idx), sequence_length=self.sequence_length).to(self.device)
+        compiled = _compile(model)
         optimizer = optim.Adam(model.parameters(), lr=lr)
         criterion = nn.CrossEntropyLoss()
+        use_amp = self.device.type == "cuda"
+        use_bf16 = use_amp and torch.cuda.is_bf16_supported()
+        amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+        scaler = torch.amp.GradScaler(self.device.type, enabled=use_amp and not use_bf16)
 
         for epoch in range(1, epochs + 1):
-            losses = []
+            epoch_loss = torch.zeros((), device=self.device)
+            count = 0
             for xb, yb in loader:
+                xb = xb.to(self.device, non_blocking=True)
+                yb = yb.to(self.device, non_blocking=True)
                 optimizer.zero_grad()
-                out = model(xb)
-                loss = criterion(out.reshape(-1, out.size(-1)), yb.reshape(-1))
-                loss.backward()
+                with torch.autocast(self.device.type, dtype=amp_dtype, enabled=use_amp):
+                    out = compiled(xb)
+                    loss = criterion(out.reshape(-1, out.size(-1)), yb.reshape(-1))
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
                 nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                optimizer.step()
-                losses.append(loss.item())
-            mean_loss = float(np.mean(losses))
+                scaler.step(optimizer)
+                scaler.update()
+                epoch_loss += loss.detach().float()
+                count += 1
+            mean_loss = (epoch_loss / max(count, 1)).item()
             print(f"[TRAIN] Epoch {epoch:02d}/{epochs} | Loss {mean_loss:.4f}")
         artifact = self.models_dir / "daft_transformer.pth"
         torch.save(
@@ -124,39 +229,51 @@ class DaftMIDITrainer:
             artifact,
         )
         print(f"[MODEL] Saved transformer to {artifact}")
-        self.model = model
+        self._model_mtime_ns = artifact.stat().st_mtime_ns
+        self.model = self._inference_model(model)
         return artifact
 
-    def _ensure_model(self) -> DaftMIDITransformer:
-        if self.model is not None:
-            return self.model
+    def _inference_model(self, model: DaftMIDITransformer) -> nn.Module:
+        model.eval()
+        if not self.compile_inference:
+            return model
+        mode = "reduce-overhead" if self.device.type == "cuda" else "default"
+        return _compile(model, dynamic=False, mode=mode)
+
+    def _ensure_model(self) -> nn.Module:
         artifact = self.models_dir / "daft_transformer.pth"
+        if self.model is not None:
+            if not artifact.exists() or artifact.stat().st_mtime_ns == self._model_mtime_ns:
+                return self.model
+            print(f"[MODEL] {artifact} changed on disk; reloading")
+        if not artifact.exists():
+            raise RuntimeError(f"No trained model at {artifact}. Run with --train first.")
+        mtime_ns = artifact.stat().st_mtime_ns
         checkpoint = torch.load(artifact, map_location=self.device)
         model = DaftMIDITransformer(len(checkpoint["note_to_idx"]), sequence_length=checkpoint["sequence_length"])
         model.load_state_dict(checkpoint["state_dict"])
         model.to(self.device)
-        model.eval()
-        self.note_to_idx = checkpoint["note_to_idx"]
         mapping = checkpoint["idx_to_note"]
         if mapping and isinstance(next(iter(mapping.keys())), str):
             mapping = {int(k): v for k, v in mapping.items()}
+        if mapping and isinstance(next(iter(mapping.values())), str):
+            mapping = {i: _legacy_token(v) for i, v in mapping.items()}
         self.idx_to_note = mapping
-        self.model = model
-        return model
+        self.note_to_idx = {v: i for i, v in mapping.items()}
+        self._index_pitches()
+        self._model_mtime_ns = mtime_ns
+        self.model = self._inference_model(model)
+        return self.model
 
     def _render_notes(self, tokens: List[int], tempo: int, name: str) -> Path:
         midi = MIDIFile(1)
         midi.addTempo(0, 0, tempo)
         timestamp = 0.0
+        duration = 0.25
+        velocity = 100
         for token in tokens:
-            note_name = self.idx_to_note[token]
-            duration = 0.25
-            velocity = 100
-            if "." in note_name:
-                for component in note_name.split('.'):
-                    midi.addNote(0, 0, note.Note(component).pitch.midi, timestamp, duration, velocity)
-            else:
-                midi.addNote(0, 0, note.Note(note_name).pitch.midi, timestamp, duration, velocity)
+            for pitch in self.idx_to_midi[token]:
+                midi.addNote(0, 0, pitch, timestamp, duration, velocity)
             timestamp += duration
         output = self.midis_dir / f"{name}.mid"
         with open(output, "wb") as handle:
@@ -167,20 +284,21 @@ class DaftMIDITrainer:
     def generate_transformer(self, style: str, tempo: int, bars: int) -> Path:
         model = self._ensure_model()
         seed_note = {
-            "da_funk": "C2",
-            "around_world": "D2",
-            "harder_better": "F2",
-        }.get(style, "C2")
-        sequence = [self.note_to_idx.get(seed_note, 0)] * self.sequence_length
-        generated: List[int] = []
+            "da_funk": 36,
+            "around_world": 38,
+            "harder_better": 41,
+        }.get(style, 36)
+        seq = torch.full((1, self.sequence_length), self.note_to_idx.get(seed_note, 0), dtype=torch.long, device=self.device)
         total_steps = bars * 16
-        for _ in range(total_steps):
-            logits = model(torch.tensor([sequence], dtype=torch.long, device=self.device))
-            probabilities = torch.softmax(logits[0, -1], dim=0).cpu().numpy()
-            token = int(np.random.choice(len(probabilities), p=probabilities))
-            generated.append(token)
-            sequence = sequence[1:] + [token]
-        return self._render_notes(generated, tempo, f"daft_gen_{style}")
+        generated = torch.empty(total_steps, dtype=torch.long, device=self.device)
+        with torch.inference_mode():
+            for step in range(total_steps):
+                logits = model(seq)[:, -1, :]
+                probabilities = torch.softmax(logits, dim=-1)
+                token = torch.multinomial(probabilities, 1)
+                generated[step] = token[0, 0]
+                seq = torch.cat([seq[:, 1:], token], dim=1)
+        return self._render_notes(generated.tolist(), tempo, f"daft_gen_{style}")
 
     def generate_isobar(self, style: str, tempo: int, bars: int) -> Path:
         scale = iso.Scale.minor if style == "da_funk" else iso.Scale.major
@@ -213,18 +331,44 @@ class DaftMIDITrainer:
         except subprocess.CalledProcessError as exc:
             print(f"[WARN] Fluidsynth exited with {exc.returncode}")
 
-    def run(self, mode: str, style: str, tempo: int, bars: int) -> None:
+    def run(self, mode: str, style: str, tempo: int, bars: int) -> Path:
         if mode == "train":
             artifact = self.train()
             print(f"[DONE] Model trained: {artifact}")
-            return
-        self._download_corpus()
-        self._prepare_sequences()
+            return artifact
         if mode == "isobar":
             midi_path = self.generate_isobar(style, tempo, bars)
         else:
             midi_path = self.generate_transformer(style, tempo, bars)
         self.preview(midi_path)
+        return midi_path
+
+    def serve(self) -> None:
+        sys.stdout.reconfigure(line_buffering=True)
+        self.compile_inference = True
+        print("[SERVER] Ready")
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                op = request.get("op", "gen")
+                if op == "train":
+                    mode = "train"
+                elif op == "gen":
+                    mode = "isobar" if request.get("isobar") else "generate"
+                else:
+                    raise ValueError(f"Unknown op {op!r}")
+                result = self.run(
+                    mode,
+                    request.get("style", "da_funk"),
+                    int(request.get("tempo", 128)),
+                    int(request.get("bars", 16)),
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"[ERR] {exc}")
+                continue
+            print(f"[RESULT] {result}")
 
 
 def main() -> None:
@@ -235,7 +379,9 @@ def main() -> None:
     tempo = 128
     bars = 16
     for arg in sys.argv[1:]:
-        if arg == "--train":
+        if arg == "--server":
+            mode = "server"
+        elif arg == "--train":
             mode = "train"
         elif arg.startswith("--generate="):
             mode = "generate"
@@ -246,10 +392,11 @@ def main() -> None:
             tempo = int(arg.split("=", 1)[1])
         elif arg.startswith("--bars="):
             bars = int(arg.split("=", 1)[1])
+    if mode == "server":
+        trainer.serve()
+        return
     trainer.run(mode, style, tempo, bars)
 
 
 if __name__ == "__main__":
-    import sys
-
     main()